@@ -2,19 +2,35 @@
 """
 attendance_bot.py
 
-Telegram group attendance bot using pyTelegramBotAPI (telebot) + SQLite.
+Telegram group attendance bot using pyTelegramBotAPI (AsyncTeleBot) + SQLite.
+Handlers run on asyncio; blocking SQLite work is pushed to threads.
 
 Fixes for sqlite "database is locked":
 - use timeout on connections
 - set PRAGMA journal_mode = WAL and busy_timeout
-- serialize access with a threading.Lock() (db_lock)
+- one shared write connection opened in init_db(); writers serialized with an RLock (_WRITE_LOCK)
+- reads use a per-thread connection from read_conn(), each with its own WAL snapshot
 """
+import asyncio
+import atexit
+import base64
+import hashlib
+import json
 import os
+import queue
 import sqlite3
+import string
+import struct
 import threading
-from datetime import datetime, timedelta, timezone
-import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import timedelta
+from aiohttp import web
+from cachetools import LRUCache, TTLCache
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Update
 
 # -------------------- CONFIG --------------------
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
@@ -27,361 +43,714 @@ INACTIVE_PERIOD = timedelta(days=1)
 MINUTES_REDUCED_PER_MESSAGE = 1
 MESSAGES_TO_CLEAR_INACTIVE = 15
 SCAN_INTERVAL_SECONDS = 10 * 60
+SCAN_DEBOUNCE_SECONDS = 60  # /attendance rescans first only if the last scan is older than this
 PAGE_SIZE = 10
+TEXT_BUDGET = 3900  # max chars of user lines per page; Telegram's cap is 4096 incl. header
 SQLITE_TIMEOUT = 30.0  # seconds to wait for locks
+WRITE_FLUSH_SECONDS = 0.1  # max delay before queued message activity is committed
+WRITE_BATCH_MAX = 500  # max queued messages per commit
+LONG_POLL_SECONDS = 30  # getUpdates holds the request open this long waiting for updates
+API_CONCURRENCY = 30  # max in-flight attendance API calls (Telegram allows ~30 msg/s per bot)
+# Webhook mode (USE_WEBHOOK=1) for high-traffic deployments; long polling stays the default
+USE_WEBHOOK = os.environ.get("USE_WEBHOOK") == "1"
+PUBLIC_URL = os.environ.get("PUBLIC_URL", "").rstrip("/")  # https base URL Telegram can reach
+WEBHOOK_PATH = "/tg"
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # optional; Telegram echoes it in a header
+if USE_WEBHOOK and not PUBLIC_URL:
+    raise RuntimeError("Please set PUBLIC_URL environment variable when USE_WEBHOOK=1")
 # ------------------------------------------------
 
-# ---------------- SQLite adapters/converters ----------------
-def adapt_datetime(dt: datetime):
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.isoformat()
-
-def convert_datetime(s):
-    return datetime.fromisoformat(s.decode())
+# Timestamps are stored as INTEGER unix seconds, so durations are used in seconds too
+INACTIVE_THRESHOLD_SECONDS = int(INACTIVE_THRESHOLD.total_seconds())
+INACTIVE_PERIOD_SECONDS = int(INACTIVE_PERIOD.total_seconds())
+
+# Page size is bounded by the char budget so a full page always fits one message:
+# the longest format_user_line() is a 64+1+64 char name plus " | Inactive 999d 23h 59m".
+MAX_LINE_CHARS = 160
+ROWS_PER_PAGE = max(1, min(PAGE_SIZE, TEXT_BUDGET // MAX_LINE_CHARS))
+
+# ---------------- SQL ----------------
+# Every runtime statement is a module-level constant so the text passed to execute() is
+# identical on each call and sqlite3's per-connection statement cache always hits.
+SQL_USER_EXISTS = "SELECT user_id FROM users WHERE user_id = ?"
+SQL_COUNT_USERS = "SELECT COUNT(*) FROM users"
+# name_key is written by every statement that sets a name, through the name_key_of()
+# SQL function db_conn() registers (see name_key_of() for why it isn't LOWER()).
+# Upserts recompute it from the merged names: SET expressions see the old row.
+_MERGED_NAME_KEY = "name_key_of(COALESCE(excluded.username, username), COALESCE(excluded.first_name, first_name), user_id)"
+SQL_UPDATE_USER_NAMES = """
+    UPDATE users SET
+        username = COALESCE(?1, username),
+        first_name = COALESCE(?2, first_name),
+        last_name = COALESCE(?3, last_name),
+        name_key = name_key_of(COALESCE(?1, username), COALESCE(?2, first_name), user_id)
+    WHERE user_id = ?4
+"""
+SQL_INSERT_USER = """
+    INSERT INTO users (user_id, username, first_name, last_name, last_active, name_key)
+    VALUES (?1, ?2, ?3, ?4, ?5, name_key_of(?2, ?3, ?1))
+"""
+# a joining member: upsert_user()'s name merge, and last_active set to the join time
+SQL_RECORD_JOIN = f"""
+    INSERT INTO users (user_id, username, first_name, last_name, last_active, name_key)
+    VALUES (?1, ?2, ?3, ?4, ?5, name_key_of(?2, ?3, ?1))
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = COALESCE(excluded.username, username),
+        first_name = COALESCE(excluded.first_name, first_name),
+        last_name = COALESCE(excluded.last_name, last_name),
+        name_key = {_MERGED_NAME_KEY},
+        last_active = excluded.last_active,
+        messages_since_inactive = CASE WHEN inactive_until IS NOT NULL AND inactive_until > excluded.last_active THEN messages_since_inactive ELSE 0 END
+"""
+# Each message from an inactive user shaves MINUTES_REDUCED_PER_MESSAGE off the mark and
+# clears it once the time runs out or MESSAGES_TO_CLEAR_INACTIVE is reached; ?6 is the
+# number of messages. Both only move one way, so applying n at once matches applying
+# them one by one. All SET expressions see the old row, so _CLEARS_INACTIVE is the
+# same test in each of them.
+_REDUCE_STEP = MINUTES_REDUCED_PER_MESSAGE * 60
+_CLEARS_INACTIVE = (f"(COALESCE(messages_since_inactive, 0) + ?6 >= {MESSAGES_TO_CLEAR_INACTIVE}"
+                    f" OR inactive_until - {_REDUCE_STEP} * ?6 <= excluded.last_active)")
+# upsert, last_active and the reduction for one sender's messages in a batch
+SQL_RECORD_ACTIVITY = f"""
+    INSERT INTO users (user_id, username, first_name, last_name, last_active, name_key)
+    VALUES (?1, ?2, ?3, ?4, ?5, name_key_of(?2, ?3, ?1))
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = COALESCE(excluded.username, username),
+        first_name = COALESCE(excluded.first_name, first_name),
+        last_name = COALESCE(excluded.last_name, last_name),
+        name_key = {_MERGED_NAME_KEY},
+        last_active = excluded.last_active,
+        inactive_until = CASE
+            WHEN inactive_until IS NULL OR {_CLEARS_INACTIVE} THEN NULL
+            ELSE inactive_until - {_REDUCE_STEP} * ?6 END,
+        inactive_marked_at = CASE
+            WHEN inactive_until IS NULL OR {_CLEARS_INACTIVE} THEN NULL
+            ELSE inactive_marked_at END,
+        messages_since_inactive = CASE
+            WHEN inactive_until IS NULL OR {_CLEARS_INACTIVE} THEN 0
+            ELSE COALESCE(messages_since_inactive, 0) + ?6 END
+"""
+# ids are passed as one JSON array so the statement text doesn't depend on how many there are
+SQL_EXISTING_IDS = "SELECT user_id FROM users WHERE user_id IN (SELECT value FROM json_each(?))"
+SQL_SCAN_UPDATE = """
+    UPDATE users SET inactive_until = ?, inactive_marked_at = ?, messages_since_inactive = 0
+    WHERE inactive_until IS NULL AND last_active IS NOT NULL AND last_active <= ?
+"""
+# returns (active, inactive, total) in a single pass
+SQL_ATTENDANCE_COUNTS = """
+    SELECT COUNT(*) FILTER (WHERE inactive_until IS NULL OR inactive_until <= ?),
+           COUNT(*) FILTER (WHERE inactive_until > ?),
+           COUNT(*)
+    FROM users
+"""
+SQL_NAME_KEY = "SELECT name_key FROM users WHERE user_id = ?"
+
+# WHERE conditions for the /attendance filter buttons; each takes `now` once
+ATTENDANCE_FILTERS = {
+    'all': "",
+    'active': "(inactive_until IS NULL OR inactive_until <= ?)",
+    'inactive': "inactive_until > ?",
+}
+
+# sort_mode -> (key column, whether the list is shown in descending order)
+ATTENDANCE_SORTS = {
+    'name': ('name_key', False),
+    'last': ("last_active", True),
+}
+
+def _attendance_page_sql(filter_mode, sort_mode, seek, ascending):
+    key_sql = ATTENDANCE_SORTS[sort_mode][0]
+    conditions = [ATTENDANCE_FILTERS[filter_mode]] if ATTENDANCE_FILTERS[filter_mode] else []
+    if seek:
+        op = '>' if ascending else '<'
+        # the plain key bound lets SQLite seek the index; the row value breaks ties on user_id
+        conditions.append(f"{key_sql} {op}= ? AND ({key_sql}, user_id) {op} (?, ?)")
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    direction = "" if ascending else " DESC"
+    return f"""
+        SELECT user_id, username, first_name, last_name, last_active, inactive_until
+        FROM users{where}
+        ORDER BY {key_sql}{direction}, user_id{direction}
+        LIMIT ?
+    """
 
-sqlite3.register_adapter(datetime, adapt_datetime)
-sqlite3.register_converter("TIMESTAMP", convert_datetime)
-sqlite3.register_converter("timestamp", convert_datetime)
+# (filter_mode, sort_mode, has anchor, ascending scan) -> page query
+SQL_ATTENDANCE_PAGE = {
+    (filter_mode, sort_mode, seek, ascending): _attendance_page_sql(filter_mode, sort_mode, seek, ascending)
+    for filter_mode in ATTENDANCE_FILTERS
+    for sort_mode in ATTENDANCE_SORTS
+    for seek in (False, True)
+    for ascending in (False, True)
+}
 # ----------------------------------------------------------------
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML')
-
-# DB lock to serialize access across threads (polling handlers + background scanner)
-db_lock = threading.Lock()
+# AsyncTeleBot already sends every call over one pooled aiohttp session; bound that
+# pool, time out a stalled call soon after a long poll would have returned, and retry
+# transient network errors with a 5 s backoff instead of failing the handler
+asyncio_helper.REQUEST_LIMIT = API_CONCURRENCY + 1  # + the long-poll getUpdates
+asyncio_helper.REQUEST_TIMEOUT = LONG_POLL_SECONDS + 5
+asyncio_helper.RETRY_ON_ERROR = True
+asyncio_helper.RETRY_TIMEOUT = 5
+bot = AsyncTeleBot(BOT_TOKEN, parse_mode='HTML')
+
+# Single shared write connection, opened once by init_db(). Writers take _WRITE_LOCK.
+_CONN = None
+_WRITE_LOCK = threading.RLock()
+# Readers get one persistent connection per thread (see read_conn()); the pool
+# stays as small as the asyncio.to_thread() executor. All are closed at exit.
+_TLS = threading.local()
+_READ_CONNS = []
+_READ_CONNS_LOCK = threading.Lock()
+# Bumped by every write transaction that changed rows; part of the render cache key.
+_users_version = 0
+# Recently seen user ids known to have a row, so the writer only has to look up
+# new senders to keep _total_users current. Only touched under _WRITE_LOCK.
+_KNOWN_USERS = TTLCache(maxsize=10_000, ttl=60)
+# Number of tracked users, kept current by the writers (under _WRITE_LOCK) so
+# /attendance can pick the small-group path without a COUNT query.
+_total_users = 0
+
+def name_key_of(username, first_name, user_id):
+    # Sort key for "Sort: Name". Python's str.lower() folds all of Unicode ("Élodie",
+    # Cyrillic, ...); SQLite's LOWER() only folds ASCII, so it can't be computed in SQL.
+    name = username or first_name
+    return name.lower() if name else str(user_id)
 
 def db_conn():
     """
-    Return a new sqlite3 connection with timeout and pragmas set.
-    Always create a fresh connection per call (don't share connections across threads).
+    Open a sqlite3 connection with timeout and pragmas set.
+    Called from init_db() for _CONN and from read_conn() once per reader thread.
+    isolation_level=None puts the connection in autocommit mode; writes go
+    through write_txn().
     """
     conn = sqlite3.connect(
         DB_PATH,
-        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
         timeout=SQLITE_TIMEOUT,
-        check_same_thread=False
+        check_same_thread=False,
+        isolation_level=None
     )
-    # Set pragmas to improve concurrency
-    # Note: executing pragmas per connection is fine.
     conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA busy_timeout = 30000;")  # 30000 ms = 30s
+    conn.execute("PRAGMA synchronous=NORMAL;")  # WAL is still crash-safe with NORMAL
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-20000;")  # negative = KiB, ~20 MB page cache
+    conn.execute("PRAGMA mmap_size=268435456;")  # 256 MB: reads come straight from the page cache
+    conn.execute(f"PRAGMA busy_timeout = {int(SQLITE_TIMEOUT * 1000)};")  # ms, same wait as timeout=
+    conn.create_function("name_key_of", 3, name_key_of, deterministic=True)
     return conn
 
+def read_conn():
+    """
+    This thread's read connection, opened on first use and kept afterwards.
+    WAL gives each read its own snapshot, so reads run alongside the writer and
+    never see a half-applied write transaction on _CONN.
+    """
+    conn = getattr(_TLS, "conn", None)
+    if conn is None:
+        conn = _TLS.conn = db_conn()
+        with _READ_CONNS_LOCK:
+            _READ_CONNS.append(conn)
+    return conn
+
+@atexit.register
+def close_db():
+    global _CONN
+    with _READ_CONNS_LOCK:
+        for conn in _READ_CONNS:
+            conn.close()
+        _READ_CONNS.clear()
+    with _WRITE_LOCK:  # let an in-flight write transaction finish first
+        if _CONN is not None:
+            _CONN.close()
+            _CONN = None
+
+@contextmanager
+def write_txn():
+    """Run writes as one transaction on the shared connection; bumps _users_version."""
+    global _users_version, _total_users
+    with _WRITE_LOCK:
+        changes_before = _CONN.total_changes
+        _CONN.execute("BEGIN")
+        try:
+            yield _CONN
+            _CONN.execute("COMMIT")
+        except BaseException:
+            # on SQLITE_FULL/IOERR/BUSY SQLite may have rolled back already; a failed
+            # COMMIT leaves the transaction open and must be rolled back here
+            if _CONN.in_transaction:
+                _CONN.execute("ROLLBACK")
+            # both may describe writes that were just rolled back
+            _KNOWN_USERS.clear()
+            _total_users = _CONN.execute(SQL_COUNT_USERS).fetchone()[0]
+            raise
+        if _CONN.total_changes != changes_before:
+            _users_version += 1
+
 # ---------------- Database helpers ----------------
-def init_db():
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS users (
+# PRAGMA user_version of the current schema:
+# 1 = timestamps as INTEGER unix seconds, 2 = no is_bot column (bots are never stored),
+# 3 = name_key is a plain column written through name_key_of()
+SCHEMA_VERSION = 3
+
+def _users_table_sql(table):
+    return f'''
+        CREATE TABLE {table} (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             first_name TEXT,
             last_name TEXT,
-            last_active TIMESTAMP,
-            inactive_until TIMESTAMP,
+            last_active INTEGER,
+            inactive_until INTEGER,
             messages_since_inactive INTEGER DEFAULT 0,
-            inactive_marked_at TIMESTAMP,
-            is_bot INTEGER DEFAULT 0
+            inactive_marked_at INTEGER,
+            name_key TEXT
         )
+    '''
+
+def _migrate_timestamps_to_epoch():
+    # ISO-8601 TIMESTAMP text -> INTEGER unix seconds. Declared column types can't
+    # be altered in place, so copy into a new table (its indexes go with the old one).
+    with write_txn() as conn:
+        conn.execute(_users_table_sql("users_migrated"))
+        conn.execute('''
+            INSERT INTO users_migrated (user_id, username, first_name, last_name, last_active,
+                                        inactive_until, messages_since_inactive, inactive_marked_at, name_key)
+            SELECT user_id, username, first_name, last_name, CAST(strftime('%s', last_active) AS INTEGER),
+                   CAST(strftime('%s', inactive_until) AS INTEGER), messages_since_inactive,
+                   CAST(strftime('%s', inactive_marked_at) AS INTEGER), name_key_of(username, first_name, user_id)
+            FROM users WHERE is_bot IS 0
         ''')
-        conn.commit()
-        conn.close()
+        conn.execute("DROP TABLE users")
+        conn.execute("ALTER TABLE users_migrated RENAME TO users")
+
+def _migrate_drop_is_bot():
+    # every query filtered on is_bot = 0 and bots are never inserted, so drop the
+    # leftover bot rows and the column (an indexed column can't be dropped)
+    with write_txn() as conn:
+        conn.execute("DELETE FROM users WHERE is_bot IS NOT 0")
+        conn.execute("DROP INDEX IF EXISTS users_last_cover")
+        conn.execute("ALTER TABLE users DROP COLUMN is_bot")
+
+def _migrate_name_key_column():
+    # the generated name_key (ASCII-only LOWER()) becomes a plain column filled by
+    # name_key_of(); a generated column can't be altered, so drop and re-add it
+    with write_txn() as conn:
+        conn.execute("DROP INDEX IF EXISTS users_name_key")
+        conn.execute("ALTER TABLE users DROP COLUMN name_key")
+        conn.execute("ALTER TABLE users ADD COLUMN name_key TEXT")
+        conn.execute("UPDATE users SET name_key = name_key_of(username, first_name, user_id)")
+
+def init_db():
+    global _CONN, _total_users
+    with _WRITE_LOCK:
+        if _CONN is None:
+            _CONN = db_conn()
+        has_users = _CONN.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone()
+        if not has_users:
+            _CONN.execute(_users_table_sql("users"))
+        else:
+            version = _CONN.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                _migrate_timestamps_to_epoch()  # rebuilds straight into the current schema
+            else:
+                if version < 2:
+                    _migrate_drop_is_bot()
+                if version < 3:
+                    _migrate_name_key_column()
+        _CONN.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        # indexes backing the ORDER BY of the two /attendance sort modes
+        # (users_last_cover is scanned backwards for "last_active DESC, user_id DESC").
+        # users_last_cover holds every column a page reads, so last-active pages never
+        # touch the table; users_name_key holds only the key, so the name sort reads its
+        # page rows from the table.
+        _CONN.execute("CREATE INDEX IF NOT EXISTS users_name_key ON users(name_key)")
+        _CONN.execute("DROP INDEX IF EXISTS users_last")
+        _CONN.execute("""
+            CREATE INDEX IF NOT EXISTS users_last_cover
+            ON users(last_active, user_id, inactive_until, username, first_name, last_name)
+        """)
+        # partial index for the inactivity scanner: only users not yet marked inactive
+        _CONN.execute("CREATE INDEX IF NOT EXISTS users_scan ON users(last_active) WHERE inactive_until IS NULL")
+        _total_users = _CONN.execute(SQL_COUNT_USERS).fetchone()[0]
 
 def upsert_user(user_id, username=None, first_name=None, last_name=None, is_bot=False):
+    global _total_users
     # Skip adding bots entirely
     if is_bot:
         return
-    now = datetime.now(timezone.utc)
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if cur.fetchone():
-            cur.execute("""
-                UPDATE users SET
-                    username = COALESCE(?, username),
-                    first_name = COALESCE(?, first_name),
-                    last_name = COALESCE(?, last_name),
-                    is_bot = COALESCE(?, is_bot)
-                WHERE user_id = ?
-            """, (username, first_name, last_name, 0, user_id))
+    now = int(time.time())
+    with write_txn() as conn:
+        if conn.execute(SQL_USER_EXISTS, (user_id,)).fetchone():
+            conn.execute(SQL_UPDATE_USER_NAMES, (username, first_name, last_name, user_id))
         else:
-            cur.execute("""
-                INSERT INTO users (user_id, username, first_name, last_name, last_active, is_bot)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (user_id, username, first_name, last_name, now, 0))
-        conn.commit()
-        conn.close()
-
-def mark_active(user_id):
-    now = datetime.now(timezone.utc)
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE users
-            SET last_active = ?,
-                messages_since_inactive = CASE WHEN inactive_until IS NOT NULL AND inactive_until > ? THEN messages_since_inactive ELSE 0 END
-            WHERE user_id = ? AND is_bot = 0
-        """, (now, now, user_id))
-        conn.commit()
-        conn.close()
-
-def get_user(user_id):
-    # read-only; still use lock to avoid concurrent schema changes
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, username, first_name, last_name, last_active, inactive_until, messages_since_inactive, inactive_marked_at, is_bot FROM users WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        conn.close()
-        return row
-
-def set_inactive(user_id):
-    now = datetime.now(timezone.utc)
-    until = now + INACTIVE_PERIOD
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE users SET inactive_until = ?, inactive_marked_at = ?, messages_since_inactive = 0 WHERE user_id = ? AND is_bot = 0
-        """, (until, now, user_id))
-        conn.commit()
-        conn.close()
-
-def clear_inactive(user_id):
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE users SET inactive_until = NULL, messages_since_inactive = 0, inactive_marked_at = NULL WHERE user_id = ? AND is_bot = 0
-        """, (user_id,))
-        conn.commit()
-        conn.close()
-
-def reduce_inactive_by_minutes(user_id, minutes=1):
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT inactive_until, messages_since_inactive FROM users WHERE user_id = ? AND is_bot = 0", (user_id,))
-        row = cur.fetchone()
-        if not row:
-            conn.close()
-            return
-        inactive_until, messages_since_inactive = row
-        if inactive_until is None:
-            conn.close()
-            return
+            conn.execute(SQL_INSERT_USER, (user_id, username, first_name, last_name, now))
+            _total_users += 1
 
-        inactive_dt = inactive_until if isinstance(inactive_until, datetime) else datetime.fromisoformat(inactive_until)
-        new_until = inactive_dt - timedelta(minutes=minutes)
-        messages_since_inactive = (messages_since_inactive or 0) + 1
-
-        if messages_since_inactive >= MESSAGES_TO_CLEAR_INACTIVE or new_until <= datetime.now(timezone.utc):
-            cur.execute("UPDATE users SET inactive_until = NULL, messages_since_inactive = 0, inactive_marked_at = NULL WHERE user_id = ? AND is_bot = 0", (user_id,))
-        else:
-            cur.execute("UPDATE users SET inactive_until = ?, messages_since_inactive = ? WHERE user_id = ? AND is_bot = 0", (new_until, messages_since_inactive, user_id))
-        conn.commit()
-        conn.close()
-
-def all_tracked_users():
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, username, first_name, last_name, last_active, inactive_until FROM users WHERE is_bot = 0")
-        rows = cur.fetchall()
-        conn.close()
-        return rows
+def record_joins(members):
+    """
+    Upsert a whole new_chat_members list of (user_id, username, first_name,
+    last_name) and mark them active, in one transaction.
+    """
+    global _total_users
+    now = int(time.time())
+    with write_txn() as conn:
+        user_ids = list({member[0] for member in members})
+        found = conn.execute(SQL_EXISTING_IDS, (json.dumps(user_ids),)).fetchall()
+        _total_users += len(user_ids) - len(found)
+        for user_id in user_ids:
+            _KNOWN_USERS[user_id] = True
+        conn.executemany(SQL_RECORD_JOIN, [(*member, now) for member in members])
+
+def record_activity(batch):
+    """
+    Apply queued (user_id, username, first_name, last_name, seen_at) messages in
+    one transaction. A burst from one sender is coalesced into a single row, and
+    SQL_RECORD_ACTIVITY does the upsert, last_active and the inactivity
+    reduction for it in one statement.
+    """
+    global _total_users
+    # user_id -> [user_id, username, first_name, last_name, last seen_at, message count];
+    # a name field keeps its latest non-None value, as COALESCE in the upsert would
+    senders = {}
+    for user_id, username, first_name, last_name, seen_at in batch:
+        row = senders.get(user_id)
+        if row is None:
+            senders[user_id] = [user_id, username, first_name, last_name, seen_at, 1]
+            continue
+        for i, value in ((1, username), (2, first_name), (3, last_name)):
+            if value is not None:
+                row[i] = value
+        row[4] = seen_at
+        row[5] += 1
+    with write_txn() as conn:
+        # look up unknown senders before the upsert; the ones not found are new users
+        unknown = [user_id for user_id in senders if user_id not in _KNOWN_USERS]
+        if unknown:
+            found = conn.execute(SQL_EXISTING_IDS, (json.dumps(unknown),)).fetchall()
+            _total_users += len(unknown) - len(found)
+            for user_id in unknown:
+                _KNOWN_USERS[user_id] = True
+        conn.executemany(SQL_RECORD_ACTIVITY, senders.values())
+
+# ---------------- Write queue ----------------
+# Message handlers only enqueue; one writer thread commits the activity in
+# batches, so a burst of messages costs one commit (and fsync) per flush.
+# A None on the queue tells the writer to flush what it has and exit.
+_WRITE_Q = queue.Queue()
+_WRITER = None  # the writer thread, started at startup
+
+def _writer_loop():
+    stopping = False
+    while not stopping:
+        batch = []
+        item = _WRITE_Q.get()
+        deadline = time.monotonic() + WRITE_FLUSH_SECONDS
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= WRITE_BATCH_MAX:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _WRITE_Q.get(timeout=remaining)
+            except queue.Empty:
+                break
+        stopping = item is None
+        if not batch:
+            continue
+        try:
+            record_activity(batch)
+        except Exception as e:
+            # keep the writer alive; this batch is lost
+            print(f"Failed to record {len(batch)} messages: {e}")
+
+@atexit.register
+def flush_writes():
+    # registered after close_db(), so it runs first: write out everything still
+    # queued before the connection goes away
+    if _WRITER is not None and _WRITER.is_alive():
+        _WRITE_Q.put(None)
+        _WRITER.join()
+
+# ---------------- Attendance queries ----------------
+def attendance_counts(now):
+    return read_conn().execute(SQL_ATTENDANCE_COUNTS, (now, now)).fetchone()
+
+@lru_cache(maxsize=8)
+def _counts_for(version, minute):
+    # paging doesn't change the dataset: every Prev/Next (and filter/sort) tap in the
+    # same users version and minute reuses one COUNT scan
+    return attendance_counts(int(time.time()))
+
+def attendance_page(now, filter_mode, sort_mode, anchor=None, backwards=False, page_size=ROWS_PER_PAGE):
+    """
+    Keyset pagination: up to page_size rows after (or, if backwards, before) the
+    anchor (user_id, sort key) in display order; anchor None = first page.
+    A None sort key is looked up from the anchor's row instead.
+    Returns (rows in display order, whether more rows exist in that direction).
+    """
+    if filter_mode not in ATTENDANCE_FILTERS:
+        filter_mode = 'all'
+    if sort_mode not in ATTENDANCE_SORTS:
+        sort_mode = 'last'
+    ascending = ATTENDANCE_SORTS[sort_mode][1] == backwards
+    conn = read_conn()
+    params = [now] if ATTENDANCE_FILTERS[filter_mode] else []
+    if anchor is not None:
+        user_id, key = anchor
+        if key is None:
+            row = conn.execute(SQL_NAME_KEY, (user_id,)).fetchone()
+            if row is None:
+                return [], False
+            key = row[0]
+        params += [key, key, user_id]
+    params.append(page_size + 1)
+    sql = SQL_ATTENDANCE_PAGE[(filter_mode, sort_mode, anchor is not None, ascending)]
+    rows = conn.execute(sql, params).fetchall()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    return rows, more
 
 # ---------------- Background scanner ----------------
-def scan_and_mark_inactive():
-    now = datetime.now(timezone.utc)
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, last_active, inactive_until FROM users WHERE is_bot = 0")
-        rows = cur.fetchall()
-        for user_id, last_active, inactive_until in rows:
-            if last_active is None:
-                continue
-            last_active_dt = last_active if isinstance(last_active, datetime) else datetime.fromisoformat(last_active)
-            if inactive_until:
-                continue
-            if now - last_active_dt >= INACTIVE_THRESHOLD:
-                until = now + INACTIVE_PERIOD
-                cur.execute("UPDATE users SET inactive_until = ?, inactive_marked_at = ?, messages_since_inactive = 0 WHERE user_id = ? AND is_bot = 0", (until, now, user_id))
-        conn.commit()
-        conn.close()
-    # schedule next run
-    threading.Timer(SCAN_INTERVAL_SECONDS, scan_and_mark_inactive).start()
+_last_scan = float("-inf")  # time.monotonic() of the last scan, from either caller
 
 def scan_and_mark_inactive_once():
-    now = datetime.now(timezone.utc)
-    with db_lock:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, last_active, inactive_until FROM users WHERE is_bot = 0")
-        rows = cur.fetchall()
-        for user_id, last_active, inactive_until in rows:
-            if last_active is None:
-                continue
-            last_active_dt = last_active if isinstance(last_active, datetime) else datetime.fromisoformat(last_active)
-            if inactive_until:
-                continue
-            if now - last_active_dt >= INACTIVE_THRESHOLD:
-                until = now + INACTIVE_PERIOD
-                cur.execute("UPDATE users SET inactive_until = ?, inactive_marked_at = ?, messages_since_inactive = 0 WHERE user_id = ? AND is_bot = 0", (until, now, user_id))
-        conn.commit()
-        conn.close()
+    # one set-based UPDATE; the users_scan partial index matches its predicate,
+    # so the cost follows the number of candidates rather than the table size
+    global _last_scan
+    _last_scan = time.monotonic()
+    now = int(time.time())
+    with write_txn() as conn:
+        conn.execute(SQL_SCAN_UPDATE, (now + INACTIVE_PERIOD_SECONDS, now, now - INACTIVE_THRESHOLD_SECONDS))
+
+# Set at exit so the scanner stops between ticks instead of being cut off mid-sleep
+_STOP_EVENT = threading.Event()
+atexit.register(_STOP_EVENT.set)  # runs before close_db(), which was registered earlier
+
+def _scan_loop():
+    # one long-lived thread instead of a new threading.Timer thread every tick
+    while True:
+        try:
+            scan_and_mark_inactive_once()
+        except sqlite3.Error as e:
+            print(f"Inactivity scan failed: {e}")
+        if _STOP_EVENT.wait(SCAN_INTERVAL_SECONDS):
+            return
 
 # ---------------- Utilities for display ----------------
-def format_user_line(row):
+_HEADER_TMPL = (
+    "<b>Attendance</b> — <i>%s</i> — Sorted by <i>%s</i>\n"
+    "Active: <b>%d</b>  |  Inactive: <b>%d</b>  |  Total: <b>%d</b>\n"
+    "Page %d / %d\n\n"
+)
+_INACTIVE_LINE_TMPL = "%s | Inactive %dd %dh %dm"
+
+def format_user_line(row, now):
     user_id, username, first_name, last_name, last_active, inactive_until = row
     if username:
-        display = f"@{username}"
+        display = "@" + username
     else:
         display = (first_name or "") + ((" " + last_name) if last_name else "")
-        display = display.strip() or f"user_{user_id}"
-    status = "Active"
-    if inactive_until:
-        until_dt = inactive_until if isinstance(inactive_until, datetime) else datetime.fromisoformat(inactive_until)
-        if until_dt > datetime.now(timezone.utc):
-            delta = until_dt - datetime.now(timezone.utc)
-            days = delta.days
-            hours, remainder = divmod(delta.seconds, 3600)
-            minutes = remainder // 60
-            status = f"Inactive {days}d {hours}h {minutes}m"
-        else:
-            status = "Active"
-    return f"{display} | {status}"
-
-def compute_counts(rows):
-    now = datetime.now(timezone.utc)
-    active = inactive = total = 0
-    for r in rows:
-        total += 1
-        inactive_until = r[5]
-        if inactive_until:
-            until_dt = inactive_until if isinstance(inactive_until, datetime) else datetime.fromisoformat(inactive_until)
-            if until_dt > now:
-                inactive += 1
-            else:
-                active += 1
-        else:
-            active += 1
-    return active, inactive, total
-
-def filter_and_sort_users(rows, filter_mode='all', sort_mode='name'):
-    processed = []
-    for r in rows:
-        user_id, username, first_name, last_name, last_active, inactive_until = r
-        is_inactive = False
-        if inactive_until:
-            until_dt = inactive_until if isinstance(inactive_until, datetime) else datetime.fromisoformat(inactive_until)
-            is_inactive = until_dt > datetime.now(timezone.utc)
-        if filter_mode == 'active' and is_inactive:
-            continue
-        if filter_mode == 'inactive' and not is_inactive:
-            continue
-        name_key = (username or (first_name or "")).lower() if (username or first_name) else str(user_id)
-        last_key = last_active if isinstance(last_active, datetime) else (datetime.fromisoformat(last_active) if last_active else datetime.fromtimestamp(0, tz=timezone.utc))
-        processed.append((r, name_key, last_key))
-    if sort_mode == 'name':
-        processed.sort(key=lambda t: t[1])
-    else:
-        processed.sort(key=lambda t: t[2], reverse=True)
-    return [t[0] for t in processed]
-
-def build_attendance_text(paged_rows, active_count, inactive_count, total_count, page, page_size, filter_mode, sort_mode):
-    total_pages = (total_count + page_size - 1)//page_size if total_count else 1
-    header = (
-        f"<b>Attendance</b> — <i>{filter_mode}</i> — Sorted by <i>{'name' if sort_mode=='name' else 'last active'}</i>\n"
-        f"Active: <b>{active_count}</b>  |  Inactive: <b>{inactive_count}</b>  |  Total: <b>{total_count}</b>\n"
-        f"Page {page+1} / {total_pages}\n\n"
-    )
-    lines = [format_user_line(r) for r in paged_rows]
+        display = display.strip() or "user_%d" % user_id
+    if inactive_until and inactive_until > now:
+        days, minutes = divmod((inactive_until - now) // 60, 24 * 60)
+        hours, minutes = divmod(minutes, 60)
+        return _INACTIVE_LINE_TMPL % (display, days, hours, minutes)
+    return display + " | Active"
+
+def build_attendance_text(lines, active_count, inactive_count, total_count, page, total_pages, filter_mode, sort_mode):
+    header = _HEADER_TMPL % (filter_mode, 'name' if sort_mode == 'name' else 'last active',
+                             active_count, inactive_count, total_count, page + 1, total_pages)
     body = "(no users to show on this page)" if not lines else "\n".join(lines)
     return header + body
 
-def build_inline_keyboard(page, total_pages, filter_mode, sort_mode):
+# ---------------- Pagination cursors ----------------
+# callback_data is "ATT|<cursor>|<filter>|<sort>" and Telegram caps it at 64 bytes,
+# so the cursor is a packed (page, backwards, user_id, last_active) tuple.
+# The name sort key isn't shipped; attendance_page() looks it up from the anchor row.
+# Messages sent before cursors carry "ATT|<page number>|..."; those open the first page.
+CURSOR_FORMAT = ">H?qq"
+CURSOR_CHARS = -(-struct.calcsize(CURSOR_FORMAT) * 4 // 3)  # unpadded base64 length
+CURSOR_ALPHABET = frozenset(string.ascii_letters + string.digits + "-_")
+LEGACY_PAGE_ALPHABET = frozenset(string.digits)
+
+def encode_cursor(page, backwards, row):
+    user_id, last_active = row[0], row[4]
+    raw = struct.pack(CURSOR_FORMAT, page, backwards, user_id, last_active or 0)
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def decode_cursor(s):
+    # "" means the first page; s must already have passed parse_attendance_callback()
+    if not s:
+        return None
+    raw = base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+    return struct.unpack(CURSOR_FORMAT, raw)
+
+def parse_attendance_callback(data):
+    """
+    Validate an ATT| payload up front rather than letting split/unpack raise.
+    Returns (filter_mode, sort_mode, cursor) or None if it's malformed.
+    """
+    parts = data.split("|", 3)
+    if len(parts) != 4:
+        return None
+    _, cursor_s, filter_mode, sort_mode = parts
+    if filter_mode not in ATTENDANCE_FILTERS or sort_mode not in ATTENDANCE_SORTS:
+        return None
+    if len(cursor_s) != CURSOR_CHARS and LEGACY_PAGE_ALPHABET.issuperset(cursor_s):
+        cursor_s = ""  # a legacy page number (or already ""): the first page
+    if cursor_s and (len(cursor_s) != CURSOR_CHARS or not CURSOR_ALPHABET.issuperset(cursor_s)):
+        return None
+    return filter_mode, sort_mode, decode_cursor(cursor_s)
+
+@lru_cache(maxsize=256)
+def build_inline_keyboard(prev_cursor, next_cursor, filter_mode, sort_mode):
+    # returns the reply_markup already serialized: telebot sends a str as-is, and the
+    # cached value can be shared across renders because nothing can mutate it
     kb = InlineKeyboardMarkup()
     nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⟨ Prev", callback_data=f"ATT|{page-1}|{filter_mode}|{sort_mode}"))
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton("Next ⟩", callback_data=f"ATT|{page+1}|{filter_mode}|{sort_mode}"))
+    if prev_cursor:
+        nav_buttons.append(InlineKeyboardButton("⟨ Prev", callback_data=f"ATT|{prev_cursor}|{filter_mode}|{sort_mode}"))
+    if next_cursor:
+        nav_buttons.append(InlineKeyboardButton("Next ⟩", callback_data=f"ATT|{next_cursor}|{filter_mode}|{sort_mode}"))
     if nav_buttons:
         kb.row(*nav_buttons)
+    # switching filter or sort changes the ordering, so start again from page 1
     kb.row(
-        InlineKeyboardButton("All", callback_data=f"ATT|{page}|all|{sort_mode}"),
-        InlineKeyboardButton("Active", callback_data=f"ATT|{page}|active|{sort_mode}"),
-        InlineKeyboardButton("Inactive", callback_data=f"ATT|{page}|inactive|{sort_mode}")
+        InlineKeyboardButton("All", callback_data=f"ATT||all|{sort_mode}"),
+        InlineKeyboardButton("Active", callback_data=f"ATT||active|{sort_mode}"),
+        InlineKeyboardButton("Inactive", callback_data=f"ATT||inactive|{sort_mode}")
     )
     kb.row(
-        InlineKeyboardButton("Sort: Name", callback_data=f"ATT|{page}|{filter_mode}|name"),
-        InlineKeyboardButton("Sort: Last active", callback_data=f"ATT|{page}|{filter_mode}|last")
+        InlineKeyboardButton("Sort: Name", callback_data=f"ATT||{filter_mode}|name"),
+        InlineKeyboardButton("Sort: Last active", callback_data=f"ATT||{filter_mode}|last")
     )
-    return kb
+    return kb.to_json()
+
+def render_attendance(filter_mode, sort_mode, cursor=None):
+    now = int(time.time())
+    if _total_users <= ROWS_PER_PAGE:
+        # small group (the common case): one SELECT of everyone, counts and filter in Python
+        everyone, more = attendance_page(now, 'all', sort_mode, page_size=ROWS_PER_PAGE)
+        if not more:
+            # inactive_until is an int or NULL, so `(x or 0) > now` is the whole test
+            total_count = len(everyone)
+            inactive_count = sum((r[5] or 0) > now for r in everyone)
+            active_count = total_count - inactive_count
+            if filter_mode in ('active', 'inactive'):
+                want_inactive = filter_mode == 'inactive'
+                everyone = [r for r in everyone if ((r[5] or 0) > now) == want_inactive]
+            lines = [format_user_line(r, now) for r in everyone]
+            text = build_attendance_text(lines, active_count, inactive_count, total_count, 0, 1, filter_mode, sort_mode)
+            return text, build_inline_keyboard(None, None, filter_mode, sort_mode)
+
+    active_count, inactive_count, total_count = _counts_for(_users_version, now // 60)
+    total_filtered = {'active': active_count, 'inactive': inactive_count}.get(filter_mode, total_count)
+    total_pages = (total_filtered + ROWS_PER_PAGE - 1) // ROWS_PER_PAGE if total_filtered else 1
+
+    page, backwards, anchor = 0, False, None
+    if cursor:
+        page, backwards, user_id, key = cursor
+        anchor = (user_id, None if sort_mode == 'name' else key)
+    paged, more = attendance_page(now, filter_mode, sort_mode, anchor, backwards, ROWS_PER_PAGE)
+    if anchor is not None and (not paged or (backwards and not more)):
+        # walked off either end (or the data shifted under the cursor): restart at page 1
+        page, backwards = 0, False
+        paged, more = attendance_page(now, filter_mode, sort_mode, None, False, ROWS_PER_PAGE)
+    has_prev = backwards or page > 0
+    has_next = more if not backwards else True
+    page = max(1 if has_prev else 0, min(page, total_pages - (2 if has_next else 1)))
+
+    prev_cursor = encode_cursor(page - 1, True, paged[0]) if has_prev and paged else None
+    next_cursor = encode_cursor(page + 1, False, paged[-1]) if has_next and paged else None
+    lines = [format_user_line(r, now) for r in paged]
+    text = build_attendance_text(lines, active_count, inactive_count, total_count, page, total_pages, filter_mode, sort_mode)
+    kb = build_inline_keyboard(prev_cursor, next_cursor, filter_mode, sort_mode)
+    return text, kb
+
+@lru_cache(maxsize=256)
+def _render_page(version, minute, filter_mode, sort_mode, cursor):
+    # version and minute only key the cache: any write to users, or the
+    # "Inactive Xd Yh Zm" countdowns ticking over, makes it miss
+    return render_attendance(filter_mode, sort_mode, cursor)
 
 # ---------------- Telebot handlers ----------------
+# SQLite calls block, so handlers run them via asyncio.to_thread(); Telegram API
+# calls for different updates then overlap instead of queueing behind each other.
+# A burst of button taps is pipelined through at most API_CONCURRENCY calls at a time,
+# all sharing the cached render, rather than tripping Telegram's flood limits.
+_API_SLOTS = None
+
+def _api_slots():
+    # created on first use, inside the running loop: on Python 3.9 a Semaphore binds
+    # get_event_loop() when constructed, and at import that isn't asyncio.run()'s loop
+    global _API_SLOTS
+    if _API_SLOTS is None:
+        _API_SLOTS = asyncio.Semaphore(API_CONCURRENCY)
+    return _API_SLOTS
+
+# (chat_id, message_id) -> digest of what that attendance message shows, so an
+# idempotent press (same filter twice, nothing changed) skips the edit entirely
+_SHOWN = LRUCache(maxsize=1024)
+
+def render_digest(text, kb):
+    return hashlib.blake2s((text + kb).encode(), digest_size=8).digest()
+
+async def scan_if_stale():
+    # the background thread owns scanning; a handler only catches up when it's overdue
+    if time.monotonic() - _last_scan > SCAN_DEBOUNCE_SECONDS:
+        await asyncio.to_thread(scan_and_mark_inactive_once)
+
 @bot.message_handler(commands=['start'])
-def handle_start(message):
-    bot.reply_to(message, "Attendance bot is running. Add me to a group and use /attendance in the group to view statuses.")
+async def handle_start(message):
+    await bot.reply_to(message, "Attendance bot is running. Add me to a group and use /attendance in the group to view statuses.")
 
 @bot.message_handler(commands=['attendance'])
-def handle_attendance(message):
+async def handle_attendance(message):
     if message.chat.type not in ['group', 'supergroup']:
-        bot.reply_to(message, "Please use /attendance inside a group or supergroup.")
+        await bot.reply_to(message, "Please use /attendance inside a group or supergroup.")
         return
 
-    scan_and_mark_inactive_once()
-    rows = all_tracked_users()
-    active_count, inactive_count, total_count = compute_counts(rows)
-
-    filter_mode = 'all'
-    sort_mode = 'name'
-    filtered = filter_and_sort_users(rows, filter_mode=filter_mode, sort_mode=sort_mode)
-    total_filtered = len(filtered)
-    total_pages = (total_filtered + PAGE_SIZE - 1) // PAGE_SIZE if total_filtered else 1
-    page = 0
-    paged = filtered[page*PAGE_SIZE:(page+1)*PAGE_SIZE]
-
-    text = build_attendance_text(paged, active_count, inactive_count, total_count, page, PAGE_SIZE, filter_mode, sort_mode)
-    kb = build_inline_keyboard(page, total_pages, filter_mode, sort_mode)
-    bot.reply_to(message, text, reply_markup=kb)
+    await scan_if_stale()
+    text, kb = await asyncio.to_thread(_render_page, _users_version, int(time.time() // 60), 'all', 'name', None)
+    async with _api_slots():
+        sent = await bot.reply_to(message, text, reply_markup=kb)
+    _SHOWN[(sent.chat.id, sent.message_id)] = render_digest(text, kb)
 
 @bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("ATT|"))
-def handle_attendance_callback(cq):
-    try:
-        parts = cq.data.split("|")
-        _, page_s, filter_mode, sort_mode = parts
-        page = int(page_s)
-    except Exception:
-        bot.answer_callback_query(cq.id, text="Invalid callback data.")
+async def handle_attendance_callback(cq):
+    parsed = parse_attendance_callback(cq.data)
+    if parsed is None:
+        await bot.answer_callback_query(cq.id, text="Invalid callback data.")
         return
+    filter_mode, sort_mode, cursor = parsed
 
-    scan_and_mark_inactive_once()
-    rows = all_tracked_users()
-    active_count, inactive_count, total_count = compute_counts(rows)
+    await scan_if_stale()
+    text, kb = await asyncio.to_thread(_render_page, _users_version, int(time.time() // 60), filter_mode, sort_mode, cursor)
 
-    filtered = filter_and_sort_users(rows, filter_mode=filter_mode, sort_mode=sort_mode)
-    total_filtered = len(filtered)
-    total_pages = (total_filtered + PAGE_SIZE - 1) // PAGE_SIZE if total_filtered else 1
-    page = max(0, min(page, total_pages - 1))
-
-    paged = filtered[page*PAGE_SIZE:(page+1)*PAGE_SIZE]
-    text = build_attendance_text(paged, active_count, inactive_count, total_count, page, PAGE_SIZE, filter_mode, sort_mode)
-    kb = build_inline_keyboard(page, total_pages, filter_mode, sort_mode)
+    shown_key = (cq.message.chat.id, cq.message.message_id)
+    digest = render_digest(text, kb)
+    if _SHOWN.get(shown_key) == digest:
+        await bot.answer_callback_query(cq.id)
+        return
 
-    try:
-        bot.edit_message_text(text, chat_id=cq.message.chat.id, message_id=cq.message.message_id, reply_markup=kb)
-    except telebot.apihelper.ApiException:
-        bot.send_message(cq.message.chat.id, text, reply_markup=kb)
-    bot.answer_callback_query(cq.id)
+    async with _api_slots():
+        try:
+            await bot.edit_message_text(text, chat_id=cq.message.chat.id, message_id=cq.message.message_id, reply_markup=kb)
+            _SHOWN[shown_key] = digest
+        except asyncio_helper.ApiTelegramException as e:
+            if "message is not modified" in e.description:
+                _SHOWN[shown_key] = digest
+            else:
+                # e.g. the message is too old to edit: post the page as a new one
+                await bot.send_message(cq.message.chat.id, text, reply_markup=kb)
+        await bot.answer_callback_query(cq.id)
 
 @bot.message_handler(func=lambda m: True, content_types=['text', 'audio', 'document', 'photo', 'video', 'sticker', 'voice'])
-def handle_all_messages(message):
+async def handle_all_messages(message):
     if message.chat.type not in ['group', 'supergroup']:
         return
     if message.from_user is None:
@@ -394,34 +763,77 @@ def handle_all_messages(message):
     last_name = getattr(u, 'last_name', None)
     is_bot = bool(getattr(u, 'is_bot', False))
 
-    upsert_user(user_id, username=username, first_name=first_name, last_name=last_name, is_bot=is_bot)
-    if not is_bot:
-        mark_active(user_id)
-        user = get_user(user_id)
-        if user and user[5]:
-            reduce_inactive_by_minutes(user_id, MINUTES_REDUCED_PER_MESSAGE)
+    if is_bot:
+        return
+    # non-blocking: the writer thread commits it
+    _WRITE_Q.put_nowait((user_id, username, first_name, last_name, int(time.time())))
 
 @bot.message_handler(content_types=['new_chat_members'])
-def handle_new_members(message):
-    for member in message.new_chat_members:
-        is_bot = bool(getattr(member, 'is_bot', False))
-        upsert_user(member.id, username=member.username, first_name=member.first_name, last_name=getattr(member, 'last_name', None), is_bot=is_bot)
-        if not is_bot:
-            mark_active(member.id)
+async def handle_new_members(message):
+    # bots are skipped, as in upsert_user()
+    members = [
+        (member.id, member.username, member.first_name, getattr(member, 'last_name', None))
+        for member in message.new_chat_members
+        if not getattr(member, 'is_bot', False)
+    ]
+    if members:
+        await asyncio.to_thread(record_joins, members)
 
 @bot.message_handler(content_types=['left_chat_member'])
-def handle_left_member(message):
+async def handle_left_member(message):
     left = message.left_chat_member
     if left:
         is_bot = bool(getattr(left, 'is_bot', False))
-        upsert_user(left.id, username=left.username, first_name=left.first_name, last_name=getattr(left, 'last_name', None), is_bot=is_bot)
+        await asyncio.to_thread(upsert_user, left.id, username=left.username, first_name=left.first_name, last_name=getattr(left, 'last_name', None), is_bot=is_bot)
         # keep history
 
+# ---------------- Webhook ----------------
+# Only the update types handled above; new/left members arrive as "message"
+ALLOWED_UPDATES = ["message", "callback_query"]
+# strong refs to in-flight update tasks (the event loop only keeps weak ones)
+_UPDATE_TASKS = set()
+
+async def handle_webhook(request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    update = Update.de_json(await request.text())
+    # acknowledge right away, as polling does; Telegram retries slow deliveries
+    task = asyncio.create_task(bot.process_new_updates([update]))
+    _UPDATE_TASKS.add(task)
+    task.add_done_callback(_UPDATE_TASKS.discard)
+    return web.Response()
+
+async def run_webhook():
+    await bot.remove_webhook()
+    await bot.set_webhook(url=PUBLIC_URL + WEBHOOK_PATH, allowed_updates=ALLOWED_UPDATES, secret_token=WEBHOOK_SECRET)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=WEBHOOK_PORT).start()
+    try:
+        await asyncio.Event().wait()  # serve until the process is stopped
+    finally:
+        await runner.cleanup()
+        await bot.close_session()
+
+async def run_polling():
+    # getUpdates fails with 409 Conflict while a webhook is set, e.g. one left
+    # behind by an earlier USE_WEBHOOK=1 run, and infinity_polling retries forever
+    await bot.delete_webhook()
+    await bot.infinity_polling(timeout=LONG_POLL_SECONDS, allowed_updates=ALLOWED_UPDATES)
+
 # ---------------- Startup ----------------
 if __name__ == '__main__':
     print("Initializing database...")
     init_db()
+    _WRITER = threading.Thread(target=_writer_loop, daemon=True)
+    _WRITER.start()
     print("Starting background scanner...")
-    threading.Timer(SCAN_INTERVAL_SECONDS, scan_and_mark_inactive).start()
-    print("Bot polling started...")
-    bot.infinity_polling()
+    threading.Thread(target=_scan_loop, daemon=True).start()
+    if USE_WEBHOOK:
+        print(f"Bot webhook listening on port {WEBHOOK_PORT}...")
+        asyncio.run(run_webhook())
+    else:
+        print("Bot polling started...")
+        asyncio.run(run_polling())